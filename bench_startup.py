@@ -0,0 +1,83 @@
+"""forum.py / teacher.py の起動（コールドスタート）と rerun の所要時間を測るベンチマーク。
+
+各計測は新しいプロセスで行い、loadtest.py のインメモリ Firestore を使う。
+ログイン画面の初回表示、ログイン後の初回表示、一覧画面の rerun 時間と、
+画像を扱うまで OpenCV / NumPy が読み込まれていないかを表示する。
+
+例:
+    python bench_startup.py --script forum.py --runs 5 --reruns 50
+    git show HEAD~1:forum.py > /tmp/forum_before.py && python bench_startup.py --script /tmp/forum_before.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+def child(script, reruns):
+    import loadtest
+    from streamlit.testing.v1 import AppTest
+
+    backend = loadtest.FakeBackend()
+    loadtest.install_fake_firebase(backend)
+    loadtest.seed_backend(backend, 50, 10)
+    role = "teacher" if os.path.basename(script).startswith("teacher") else "student"
+    at = AppTest.from_file(script, default_timeout=60)
+    at.secrets["student"] = {"password": loadtest.STUDENT_PASSWORD}
+    at.secrets["teacher"] = {"password": loadtest.TEACHER_PASSWORD}
+
+    start = time.perf_counter()
+    at.run()
+    login_page = time.perf_counter() - start
+
+    at.text_input[0].input(loadtest.STUDENT_PASSWORD if role == "student" else loadtest.TEACHER_PASSWORD)
+    at.button(key="student_login" if role == "student" else "teacher_login").click()
+    start = time.perf_counter()
+    at.run()
+    first_view = time.perf_counter() - start
+
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        at.run()
+        timings.append(time.perf_counter() - start)
+    return {
+        "login_page_ms": login_page * 1000,
+        "first_view_ms": first_view * 1000,
+        "rerun_ms": statistics.median(timings) * 1000,
+        "cv2_loaded": "cv2" in sys.modules,
+        "numpy_loaded": "numpy" in sys.modules,
+        "errors": len(at.exception),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="起動・rerun 時間のベンチマーク")
+    parser.add_argument("--script", default="forum.py")
+    parser.add_argument("--runs", type=int, default=5, help="コールドスタートを計測するプロセス数")
+    parser.add_argument("--reruns", type=int, default=50, help="1 プロセスあたりの rerun 回数")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(child(args.script, args.reruns)))
+        return
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")])))
+    results = []
+    for _ in range(args.runs):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--script", args.script, "--reruns", str(args.reruns)],
+            capture_output=True, text=True, check=True, env=env,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    print(f"script: {args.script} ({args.runs} runs, {args.reruns} reruns each)")
+    for key in ("login_page_ms", "first_view_ms", "rerun_ms"):
+        values = [r[key] for r in results]
+        print(f"{key:<15} median {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}")
+    print(f"cv2 loaded: {any(r['cv2_loaded'] for r in results)}, numpy loaded: {any(r['numpy_loaded'] for r in results)}, "
+          f"errors: {sum(r['errors'] for r in results)}")
+
+if __name__ == "__main__":
+    main()
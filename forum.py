@@ -2,11 +2,11 @@ import streamlit as st
 import base64
 from datetime import datetime
 from zoneinfo import ZoneInfo  # タイムゾーン設定用
-import firebase_admin
-from firebase_admin import credentials, firestore
 import ast
-import cv2
-import numpy as np
+import uuid
+from forum_common import DEFAULT_COURSE, course_name, course_password, course_prefix, select_course
+from forum_common import thread_doc_id, delete_message, student_post_stats, get_write_queue
+from forum_common import to_message, fetch_image, store_image, image_link, purge_thread, fetch_all_questions, fetch_questions_by_title, clear_question_cache
 
 # ---------- CSS 注入：新規質問投稿 Expander ヘッダー背景（黄緑） ----------
 st.markdown(
@@ -26,68 +26,46 @@ if "student_authenticated" not in st.session_state:
 
 if not st.session_state.student_authenticated:
     st.title("生徒ログイン")
+    course_id = select_course()
     password = st.text_input("パスワードを入力", type="password")
     if st.button("ログイン", key="student_login"):
-        if password == st.secrets["student"]["password"]:
+        expected_password = course_password(course_id, "student")
+        if expected_password is None:
+            st.error("このコースのパスワードが設定されていません。")
+        elif password == expected_password:
             st.session_state.student_authenticated = True
+            st.session_state.course = course_id
+            st.session_state.course_prefix = course_prefix(course_id)
+            st.session_state.course_name = course_name(course_id)
             st.rerun()
         else:
             st.error("パスワードが違います。")
     st.stop()
 
-# ---------- 画像圧縮処理 ----------
-def process_image(image_file, max_size=1000000, max_width=800, initial_quality=95):
-    try:
-        image_file.seek(0)
-        file_bytes = np.asarray(bytearray(image_file.read()), dtype=np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-    except Exception:
-        st.error("画像の読み込みに失敗しました。")
-        return None
-    if img is None:
-        st.error("画像のデコードに失敗しました。")
-        return None
-    height, width, _ = img.shape
-    if width > max_width:
-        ratio = max_width / width
-        new_width = max_width
-        new_height = int(height * ratio)
-        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-    quality = initial_quality
-    while quality >= 10:
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-        result, encimg = cv2.imencode('.jpg', img, encode_param)
-        if not result:
-            st.error("画像の圧縮に失敗しました。")
-            return None
-        size = encimg.nbytes
-        if size <= max_size:
-            return encimg.tobytes()
-        quality -= 5
-    st.error("画像の圧縮に失敗しました。")
-    return None
-
 # ---------- Firestore 初期化 ----------
-if not firebase_admin._apps:
-    try:
-        firebase_creds = st.secrets["firebase"]
-        if isinstance(firebase_creds, str):
-            firebase_creds = ast.literal_eval(firebase_creds)
-        elif not isinstance(firebase_creds, dict):
-            firebase_creds = dict(firebase_creds)
-        cred = credentials.Certificate(firebase_creds)
-    except KeyError:
-        cred = credentials.Certificate("serviceAccountKey.json")
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+# 認証情報の解析とクライアント生成はプロセスで 1 回だけ行い、rerun ごとには繰り返さない
+@st.cache_resource
+def get_db():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    if not firebase_admin._apps:
+        try:
+            firebase_creds = st.secrets["firebase"]
+            if isinstance(firebase_creds, str):
+                firebase_creds = ast.literal_eval(firebase_creds)
+            elif not isinstance(firebase_creds, dict):
+                firebase_creds = dict(firebase_creds)
+            cred = credentials.Certificate(firebase_creds)
+        except KeyError:
+            cred = credentials.Certificate("serviceAccountKey.json")
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+db = get_db()
 
-# ---------- キャッシュ付き Firestore アクセス ----------
-@st.cache_resource(ttl=10)
-def fetch_all_questions():
-    return list(db.collection("questions").order_by("timestamp", direction=firestore.Query.DESCENDING).stream())
-@st.cache_resource(ttl=10)
-def fetch_questions_by_title(title):
-    return list(db.collection("questions").where("title", "==", title).order_by("timestamp").stream())
+# ---------- 現在のコースのコレクション ----------
+collection_prefix = st.session_state.get("course_prefix", "")
+questions_path = collection_prefix + "questions"
+threads_path = collection_prefix + "threads"
 
 # ---------- Session State 初期化 ----------
 if "selected_title" not in st.session_state:
@@ -104,6 +82,10 @@ if "poster" not in st.session_state:
     st.session_state.poster = None
 if "pending_delete_msg_id" not in st.session_state:
     st.session_state.pending_delete_msg_id = None
+if "reply_idempotency_key" not in st.session_state:
+    st.session_state.reply_idempotency_key = uuid.uuid4().hex
+if "writer_id" not in st.session_state:
+    st.session_state.writer_id = uuid.uuid4().hex
 
 #####################################
 # 新規質問投稿フォーム
@@ -122,8 +104,8 @@ def show_new_question_form():
                 submitted = st.form_submit_button("投稿")
                 
     if submitted:
-        existing_titles = {doc.to_dict().get("title") for doc in fetch_all_questions()
-                           if not doc.to_dict().get("question", "").startswith("[SYSTEM]生徒はこの質問フォームを削除しました")}
+        existing_titles = {doc.title for doc in fetch_all_questions(db, questions_path)
+                           if not doc.question.startswith("[SYSTEM]生徒はこの質問フォームを削除しました")}
         if new_title in existing_titles:
             st.error("このタイトルはすでに存在します。")
         elif not new_title or not new_text:
@@ -133,17 +115,26 @@ def show_new_question_form():
         else:
             poster_name = poster_name or "匿名"
             time_str = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S")
-            img_data = process_image(new_image) if new_image is not None else None
-            db.collection("questions").add({
+            img_ref = store_image(db, collection_prefix, new_image) if new_image is not None else None
+            batch = db.batch()
+            batch.set(db.collection(questions_path).document(), {
                 "title": new_title,
                 "question": new_text,
-                "image": img_data,
+                "image": None,
+                "image_ref": img_ref,
                 "timestamp": time_str,
                 "deleted": 0,
                 "poster": poster_name,
                 "auth_key": auth_key
             })
-            st.cache_resource.clear()
+            stats = student_post_stats(new_title, time_str)
+            stats.update({"poster": poster_name, "auth_key": auth_key, "teacher_deleted": False})
+            batch.set(db.collection(threads_path).document(thread_doc_id(new_title)), stats, merge=True)
+            if img_ref:
+                image_path, image_id, image_fields = image_link(collection_prefix, img_ref)
+                batch.set(db.collection(image_path).document(image_id), image_fields, merge=True)
+            batch.commit()
+            clear_question_cache(questions_path, new_title)
             st.success("質問を投稿しました！")
             st.session_state.selected_title = new_title
             st.session_state.is_authenticated = True
@@ -155,22 +146,23 @@ def show_new_question_form():
 #####################################
 def show_title_list():
     st.title("📖 質問フォーラム")
+    if st.session_state.get("course", DEFAULT_COURSE) != DEFAULT_COURSE:
+        st.caption(f"コース: {st.session_state.course_name}")
     show_new_question_form()
     st.subheader("質問一覧")
     keyword_input = st.text_input("キーワード検索")
     keywords = [w.strip().lower() for w in keyword_input.split() if w.strip()] if keyword_input else []
-    docs = fetch_all_questions()
-    deleted_system_titles = {doc.to_dict().get("title") for doc in docs 
-                             if doc.to_dict().get("question", "").startswith("[SYSTEM]生徒はこの質問フォームを削除しました")}
+    docs = fetch_all_questions(db, questions_path)
+    deleted_system_titles = {doc.title for doc in docs 
+                             if doc.question.startswith("[SYSTEM]生徒はこの質問フォームを削除しました")}
     title_info = {}
     for doc in docs:
-        data = doc.to_dict()
-        if data.get("question", "").startswith("[SYSTEM]"):
+        if doc.kind == "system":
             continue
-        title = data.get("title")
-        poster = data.get("poster") or "匿名"
-        auth_key = data.get("auth_key", "")
-        timestamp = data.get("timestamp", "")
+        title = doc.title
+        poster = doc.poster
+        auth_key = doc.auth_key
+        timestamp = doc.timestamp
         if title in title_info:
             if timestamp < title_info[title]["orig_timestamp"]:
                 title_info[title]["orig_timestamp"] = timestamp
@@ -229,9 +221,9 @@ def show_title_list():
                         with col3:
                             back = st.form_submit_button("戻る")
                     if submit_auth:
-                        docs = fetch_questions_by_title(title)
+                        docs = fetch_questions_by_title(db, questions_path, title)
                         if docs:
-                            stored_auth_key = docs[0].to_dict().get("auth_key", "")
+                            stored_auth_key = docs[0].auth_key
                             if input_auth_key == stored_auth_key:
                                 st.session_state.selected_title = title
                                 st.session_state.is_authenticated = True
@@ -258,14 +250,14 @@ def show_title_list():
                         with col2:
                             cancel_del = st.form_submit_button("キャンセル")
                     if submit_del:
-                        docs = fetch_questions_by_title(title)
+                        docs = fetch_questions_by_title(db, questions_path, title)
                         if docs:
-                            stored_auth_key = docs[0].to_dict().get("auth_key", "")
+                            stored_auth_key = docs[0].auth_key
                             if input_del_auth == stored_auth_key:
                                 st.session_state.deleted_titles_student.append(title)
                                 time_str = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S")
                                 poster_name = title_info.get(title, {}).get("poster", "匿名")
-                                db.collection("questions").add({
+                                db.collection(questions_path).add({
                                     "title": title,
                                     "question": "[SYSTEM]生徒はこの質問フォームを削除しました",
                                     "timestamp": time_str,
@@ -275,21 +267,20 @@ def show_title_list():
                                     "auth_key": title_info.get(title, {}).get("auth_key", "")
                                 })
                                 st.success(f"タイトル「{title}」を削除しました。")
-                                st.cache_resource.clear()
-                                docs_for_title = fetch_questions_by_title(title)
+                                clear_question_cache(questions_path, title)
+                                docs_for_title = fetch_questions_by_title(db, questions_path, title)
                                 student_deleted = any(
-                                    doc.to_dict().get("question", "").startswith("[SYSTEM]生徒はこの質問フォームを削除しました")
+                                    doc.question.startswith("[SYSTEM]生徒はこの質問フォームを削除しました")
                                     for doc in docs_for_title
                                 )
                                 teacher_deleted = any(
-                                    doc.to_dict().get("question", "").startswith("[SYSTEM]先生は質問フォームを削除しました")
+                                    doc.question.startswith("[SYSTEM]先生は質問フォームを削除しました")
                                     for doc in docs_for_title
                                 )
                                 if student_deleted and teacher_deleted:
-                                    for doc in docs_for_title:
-                                        db.collection("questions").document(doc.id).delete()
+                                    purge_thread(db, collection_prefix, title, list(docs_for_title))
                                     st.success("両者による削除が確認されたため、データベースから完全に削除しました。")
-                                st.cache_resource.clear()
+                                clear_question_cache(questions_path, title)
                                 st.rerun()
                             else:
                                 st.error("認証キーが正しくありません。")
@@ -297,7 +288,7 @@ def show_title_list():
                         st.session_state.pending_delete_title = None
                         st.rerun()
     if st.button("更新", key="title_update"):
-        st.cache_resource.clear()
+        clear_question_cache(questions_path)
         st.rerun()
 
 #####################################
@@ -322,41 +313,27 @@ def show_chat_thread():
         """,
         unsafe_allow_html=True
     )
-    docs = fetch_questions_by_title(selected_title)
-    first_question_poster = "匿名"
-    if docs:
-        first_question = docs[0].to_dict()
-        first_question_poster = first_question.get("poster", "匿名")
-    sys_msgs = [doc.to_dict() for doc in docs if doc.to_dict().get("question", "").startswith("[SYSTEM]")]
+    docs = fetch_questions_by_title(db, questions_path, selected_title)
+    first_question_poster = docs[0].poster if docs else "匿名"
+    sys_msgs = [doc for doc in docs if doc.kind == "system"]
     if sys_msgs:
         for sys_msg in sys_msgs:
-            text = sys_msg.get("question", "")[8:]
-            st.markdown(f"<h3 style='color: red; text-align: center;'>{text}</h3>", unsafe_allow_html=True)
-    records = [doc for doc in docs if not doc.to_dict().get("question", "").startswith("[SYSTEM]")]
+            st.markdown(f"<h3 style='color: red; text-align: center;'>{sys_msg.text}</h3>", unsafe_allow_html=True)
+    records = [doc for doc in docs if doc.kind != "system"]
     if not records:
         st.write("該当する質問が見つかりません。")
         return
     for doc in records:
-        data = doc.to_dict()
-        msg_text = data.get("question", "")
-        msg_time = data.get("timestamp", "")
-        poster = data.get("poster") or "匿名"
-        deleted = data.get("deleted", 0)
-        try:
-            formatted_time = datetime.strptime(msg_time, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            formatted_time = msg_time
-        if deleted:
+        if doc.deleted:
             st.markdown("<div style='color: red;'>【投稿が削除されました】</div>", unsafe_allow_html=True)
             continue
-        if msg_text.startswith("[先生]"):
+        msg_display = doc.text
+        if doc.kind == "teacher":
             sender = "先生"
-            msg_display = msg_text[len("[先生]"):].strip()
             align = "left"
             bg_color = "#FFFFFF"  # 先生は白背景
         else:
-            sender = poster
-            msg_display = msg_text
+            sender = doc.poster
             align = "right"
             bg_color = "#DCF8C6"  # 生徒は緑背景
         # チャット枠の幅はテキストに合わせ、最大は80%
@@ -371,14 +348,15 @@ def show_chat_thread():
                   max-width: 80%;
                   word-wrap: break-word;">
                 <b>{sender}:</b> {msg_display}<br>
-                <small>({formatted_time})</small>
+                <small>({doc.display_time})</small>
               </div>
             </div>
             """,
             unsafe_allow_html=True
         )
-        if "image" in data and data["image"]:
-            img_data = base64.b64encode(data["image"]).decode("utf-8")
+        image_bytes = doc.image or (fetch_image(db, collection_prefix, doc.image_ref) if doc.image_ref else None)
+        if image_bytes:
+            img_data = base64.b64encode(image_bytes).decode("utf-8")
             # 画像コンテナ：背景色 #e6f7ff、幅80%、配置はチャットの寄せに合わせる
             align_style = "margin-left: auto;" if align=="right" else "margin-right: auto;"
             st.markdown(
@@ -392,7 +370,7 @@ def show_chat_thread():
         st.markdown("<div style='margin-bottom: 20px;'></div>", unsafe_allow_html=True)
         
                 # 生徒側は自分の投稿（[先生]以外）に対して削除ボタンを表示
-        if st.session_state.is_authenticated and ((msg_text.strip() != "") or data.get("image")) and not msg_text.startswith("[先生]"):
+        if st.session_state.is_authenticated and ((doc.question.strip() != "") or doc.image or doc.image_ref) and doc.kind != "teacher":
             if st.button("🗑", key=f"del_{doc.id}"):
                 st.session_state.pending_delete_msg_id = doc.id
                 st.rerun()
@@ -400,15 +378,57 @@ def show_chat_thread():
                 st.warning("本当にこの投稿を削除しますか？")
                 confirm_col1, confirm_col2 = st.columns(2)
                 if confirm_col1.button("はい", key=f"confirm_delete_{doc.id}"):
-                    d_ref = db.collection("questions").document(doc.id)
-                    d_ref.update({"deleted": 1})
+                    delete_message(db, questions_path, threads_path, selected_title, doc.id)
                     st.session_state.pending_delete_msg_id = None
-                    st.cache_resource.clear()
                     st.rerun()
                 if confirm_col2.button("キャンセル", key=f"cancel_delete_{doc.id}"):
                     st.session_state.pending_delete_msg_id = None
                     st.rerun()
     
+    # 送信中（キュー内）の返信を楽観的に表示する
+    write_queue = get_write_queue(db)
+    committed_ids = {doc.id for doc in docs}
+    queued = [(key, data, "送信中...") for key, data in write_queue.pending_for(questions_path, selected_title)]
+    queued += [(key, data, "送信に失敗しました") for key, data in write_queue.failed_for(questions_path, selected_title, st.session_state.writer_id)]
+    for key, data, status in queued:
+        if key in committed_ids:
+            continue
+        msg = to_message(key, data)
+        msg_display = msg.text
+        if msg.kind == "teacher":
+            sender = "先生"
+            align = "left"
+            bg_color = "#FFFFFF"
+        else:
+            sender = msg.poster
+            align = "right"
+            bg_color = "#DCF8C6"
+        st.markdown(
+            f"""
+            <div style="text-align: {align}; margin-bottom: 15px; opacity: 0.6;">
+              <div style="
+                  display: inline-block;
+                  background-color: {bg_color};
+                  padding: 10px;
+                  border-radius: 10px;
+                  max-width: 80%;
+                  word-wrap: break-word;">
+                <b>{sender}:</b> {msg_display}<br>
+                <small>({status})</small>
+              </div>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+        if status == "送信に失敗しました":
+            retry_col, discard_col = st.columns(2)
+            if retry_col.button("再送信", key=f"retry_{key}"):
+                write_queue.retry(key)
+                st.rerun()
+            if discard_col.button("破棄", key=f"discard_{key}"):
+                write_queue.discard(key)
+                st.rerun()
+
     st.markdown("<div id='latest_message'></div>", unsafe_allow_html=True)
     st.markdown(
         """
@@ -423,7 +443,7 @@ def show_chat_thread():
     )
     
     if st.button("更新", key="chat_update"):
-        st.cache_resource.clear()
+        clear_question_cache(questions_path, selected_title)
         st.rerun()
     if st.session_state.is_authenticated:
         with st.expander("返信する", expanded=False):
@@ -432,22 +452,30 @@ def show_chat_thread():
                 reply_image = st.file_uploader("画像をアップロード", type=["png", "jpg", "jpeg"], key="reply_image")
                 submitted = st.form_submit_button("送信")
                 if submitted:
-                    processed_reply = process_image(reply_image) if reply_image is not None else None
+                    reply_image_ref = store_image(db, collection_prefix, reply_image) if reply_image is not None else None
                     if not reply_text.strip() and not reply_image:
                         st.error("少なくともメッセージか画像を投稿してください。")
                     else:
                         time_str = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S")
-                        db.collection("questions").add({
+                        extra = [(threads_path, thread_doc_id(selected_title), student_post_stats(selected_title, time_str))]
+                        if reply_image_ref:
+                            extra.append(image_link(collection_prefix, reply_image_ref))
+                        accepted = write_queue.submit(st.session_state.reply_idempotency_key, questions_path, {
                             "title": selected_title,
                             "question": reply_text.strip(),
-                            "image": processed_reply,
+                            "image": None,
+                            "image_ref": reply_image_ref,
                             "timestamp": time_str,
                             "deleted": 0,
                             "poster": first_question_poster
-                        })
-                        st.cache_resource.clear()
-                        st.success("返信を送信しました！")
-                        st.rerun()
+                        }, extra=extra, owner=st.session_state.writer_id)
+                        # 受け付けられなかった場合も、次の送信が同じキーで弾かれないようキーは必ず作り直す
+                        st.session_state.reply_idempotency_key = uuid.uuid4().hex
+                        if accepted:
+                            st.success("返信を送信しました！")
+                            st.rerun()
+                        else:
+                            st.error("返信を受け付けられませんでした。もう一度送信してください。")
     
     else:
         st.info("認証されていないため返信はできません。")
@@ -0,0 +1,568 @@
+"""forum.py と teacher.py が共有する処理（コース、Firestore アクセス、書き込みキュー、画像）。"""
+import hashlib
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# ---------- コース（名前空間）----------
+# st.secrets に [courses.<id>] があればコースごとに courses/<id>/ 以下のコレクション（questions / threads / images / image_index）
+# を使い、パスワードもコースごとに持つ。無ければ従来どおりルート直下のコレクションと [student] / [teacher] のパスワードを使う。
+# [courses] 導入前のデータは、どれか 1 つのコースに legacy = true を書けばそのコースとしてルート直下のまま使い続けられる。
+DEFAULT_COURSE = ""
+
+def get_courses():
+    courses = st.secrets.get("courses")
+    return {course_id: dict(config) for course_id, config in courses.items()} if courses else {}
+
+def course_password(course_id, role):
+    # 設定されていなければ None を返す（ログイン画面でエラーを表示する）
+    if course_id == DEFAULT_COURSE:
+        return st.secrets.get(role, {}).get("password")
+    return get_courses().get(course_id, {}).get(f"{role}_password")
+
+def course_name(course_id):
+    return get_courses().get(course_id, {}).get("name", course_id)
+
+def course_prefix(course_id):
+    # ログイン時に 1 回だけ解決して st.session_state に保存し、rerun ごとには secrets を読まない（course_name も同様）
+    if course_id == DEFAULT_COURSE or get_courses().get(course_id, {}).get("legacy"):
+        return ""
+    return f"courses/{course_id}/"
+
+def select_course():
+    courses = get_courses()
+    if not courses:
+        return DEFAULT_COURSE
+    course_id = st.query_params.get("course")
+    if course_id in courses:
+        st.caption(f"コース: {course_name(course_id)}")
+        return course_id
+    return st.selectbox("コースを選択", list(courses), format_func=course_name)
+
+# ---------- キャッシュ付き Firestore アクセス ----------
+# キャッシュにはスナップショットではなく、1 回だけデコードした不変レコード Message を載せる
+Message = namedtuple("Message", [
+    "id", "title", "question", "kind", "text", "poster", "auth_key",
+    "timestamp", "display_time", "deleted", "image", "image_ref",
+])
+
+def to_message(doc_id, data):
+    question = data.get("question", "")
+    if question.startswith("[SYSTEM]"):
+        kind, text = "system", question[len("[SYSTEM]"):]
+    elif question.startswith("[先生]"):
+        kind, text = "teacher", question[len("[先生]"):].strip()
+    else:
+        kind, text = "student", question
+    timestamp = data.get("timestamp", "")
+    try:
+        display_time = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M")
+    except Exception:
+        display_time = timestamp
+    title = data.get("title")
+    return Message(
+        id=doc_id,
+        title=sys.intern(title) if isinstance(title, str) else title,
+        question=question,
+        kind=kind,
+        text=text,
+        poster=sys.intern(data.get("poster") or "匿名"),
+        auth_key=data.get("auth_key", ""),
+        timestamp=timestamp,
+        display_time=display_time,
+        deleted=data.get("deleted", 0),
+        image=data.get("image"),
+        image_ref=data.get("image_ref"),
+    )
+
+# キャッシュはコレクションのパスごとに分かれるので、あるコースの更新が他のコースのキャッシュを消すことはない
+@st.cache_resource(ttl=10)
+def fetch_all_questions(_db, path):
+    return tuple(to_message(doc.id, doc.to_dict()) for doc in _db.collection(path).order_by("timestamp", direction="DESCENDING").stream())
+@st.cache_resource(ttl=10)
+def fetch_questions_by_title(_db, path, title):
+    return tuple(to_message(doc.id, doc.to_dict()) for doc in _db.collection(path).where("title", "==", title).order_by("timestamp").stream())
+
+def clear_question_cache(path, title=None):
+    # 書き込みキューは st.cache_resource 上にあるため、全消去ではなく該当コースの質問キャッシュだけを消す
+    # _db はキャッシュキーに含まれないので None を渡せばよい。同じコースのスレッド集計も合わせて消す
+    fetch_all_questions.clear(None, path)
+    if title is not None:
+        fetch_questions_by_title.clear(None, path, title)
+    clear_thread_stats_cache(path[:-len("questions")] + "threads")
+
+# ---------- スレッド集計（書き込み時に更新するカウンター）----------
+# threads コレクションにスレッドごとの集計ドキュメントを置き、投稿と同じ batch（返信はトランザクション）で更新する。
+# 投稿を論理削除したときは delete_message がそのスレッドの集計を残りのメッセージから数え直す。
+#   unanswered / needs_reply: 最後の [先生] 返信以降の（削除されていない）生徒投稿数とその有無
+#   student_count: 生徒投稿の累計（削除済みも含み、減らさない）、read.<教師名>: その教師が既読にした時点の student_count
+#   last_student_at / last_teacher_at / updated_at: 最終投稿時刻
+# 教師側の一覧はこのドキュメントだけを読んで、未回答・未読での並び替えや絞り込みを行う
+# （「未回答のみ」は needs_reply と並び替えキーの複合インデックスを使う）。
+THREAD_ORDER_FIELDS = ("updated_at", "unanswered", "last_student_at")
+
+def thread_doc_id(title):
+    return hashlib.sha1(title.encode("utf-8")).hexdigest()
+
+def student_post_stats(title, time_str):
+    from firebase_admin import firestore
+    return {
+        "title": title,
+        "unanswered": firestore.Increment(1),
+        "needs_reply": True,
+        "student_count": firestore.Increment(1),
+        "last_student_at": time_str,
+        "updated_at": time_str,
+    }
+
+def teacher_post_stats(title, time_str):
+    return {
+        "title": title,
+        "unanswered": 0,
+        "needs_reply": False,
+        "last_teacher_at": time_str,
+        "updated_at": time_str,
+    }
+
+@st.cache_resource(ttl=10)
+def fetch_thread_stats(_db, path, order_field, only_unanswered):
+    query = _db.collection(path)
+    if only_unanswered:
+        query = query.where("needs_reply", "==", True)
+    return tuple(doc.to_dict() for doc in query.order_by(order_field, direction="DESCENDING").stream())
+
+def clear_thread_stats_cache(path):
+    for order_field in THREAD_ORDER_FIELDS:
+        for only_unanswered in (False, True):
+            fetch_thread_stats.clear(None, path, order_field, only_unanswered)
+
+def thread_stats_from_messages(messages):
+    # メッセージからスレッドごとの集計ドキュメントを作る。削除済みの投稿は unanswered と最終投稿時刻に含めないが、
+    # student_count は既読位置 read.<教師名> と比べる累計なので削除済みの生徒投稿も数える
+    stats = {}
+    for doc in sorted(messages, key=lambda d: d.timestamp):
+        entry = stats.setdefault(doc.title, {
+            "title": doc.title,
+            "unanswered": 0,
+            "needs_reply": False,
+            "student_count": 0,
+            "teacher_deleted": False,
+            "updated_at": doc.timestamp,
+        })
+        if doc.kind == "system":
+            if doc.question.startswith("[SYSTEM]先生は質問フォームを削除しました"):
+                entry["teacher_deleted"] = True
+            continue
+        entry.setdefault("poster", doc.poster)
+        entry.setdefault("auth_key", doc.auth_key)
+        if doc.kind == "student":
+            entry["student_count"] += 1
+        if doc.deleted:
+            continue
+        entry["updated_at"] = doc.timestamp
+        if doc.kind == "teacher":
+            entry.update({"unanswered": 0, "needs_reply": False, "last_teacher_at": doc.timestamp})
+        else:
+            entry.update({
+                "unanswered": entry["unanswered"] + 1,
+                "needs_reply": True,
+                "last_student_at": doc.timestamp,
+            })
+    return stats
+
+def delete_message(db, questions_path, threads_path, title, doc_id):
+    # 投稿の論理削除と、そのスレッドの集計の数え直しを 1 つのトランザクションで行う（既読情報 read は残す）。
+    # 集計ドキュメントも読むので、同時に返信が commit された場合はトランザクションごと再試行される。
+    # student_count は保存済みの値より小さくしない（既読位置より下がると新しい投稿が未読にならない）
+    from firebase_admin import firestore
+    message_ref = db.collection(questions_path).document(doc_id)
+    stats_ref = db.collection(threads_path).document(thread_doc_id(title))
+
+    @firestore.transactional
+    def delete(transaction):
+        snapshot = stats_ref.get(transaction=transaction)
+        messages = [to_message(doc.id, doc.to_dict())
+                    for doc in db.collection(questions_path).where("title", "==", title).stream(transaction=transaction)]
+        messages = [msg._replace(deleted=1) if msg.id == doc_id else msg for msg in messages]
+        transaction.update(message_ref, {"deleted": 1})
+        entry = thread_stats_from_messages(messages).get(title)
+        if snapshot.exists and entry is not None:
+            entry["student_count"] = max(entry["student_count"], snapshot.to_dict().get("student_count", 0))
+            transaction.set(stats_ref, entry, merge=True)
+
+    delete(db.transaction())
+    clear_question_cache(questions_path, title)
+
+# ---------- 非同期書き込みキュー ----------
+# 返信はクライアント側で生成した冪等キーをドキュメント ID として登録し、
+# ワーカースレッドがまとめてトランザクションで commit する（一時的なエラーだけ指数バックオフで再試行）。
+# 1 トランザクションの書き込みは 500 件までなので、投稿と集計の 2 件ずつで max_batch は 200 件にしている。
+# まとめた commit が失敗したときは 1 件ずつ commit し直し、問題のある投稿だけを失敗扱いにする。
+# 失敗した投稿は送信したセッション（owner）にだけ見せ、再送信・破棄できる。一定時間で破棄する。
+# extra には同じトランザクションで merge 書き込みする (コレクション, ドキュメントID, フィールド) を渡せる。
+def is_transient_error(exc):
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        from google.api_core import exceptions as api_exceptions
+    except ImportError:
+        return False
+    return isinstance(exc, (
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.InternalServerError,
+        api_exceptions.TooManyRequests,
+        api_exceptions.ResourceExhausted,
+        api_exceptions.Aborted,
+    ))
+
+class WriteQueue:
+    def __init__(self, client, on_commit=None, max_batch=200, max_retries=5, base_delay=0.5, history=10000, failed_ttl=600):
+        self.client = client
+        self.on_commit = on_commit
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.history = history
+        self.failed_ttl = failed_ttl
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._failed = {}
+        self._done = OrderedDict()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, key, path, data, extra=(), owner=None):
+        with self._lock:
+            if key in self._pending or key in self._done:
+                return False
+            self._failed.pop(key, None)
+            self._pending[key] = (path, data, tuple(extra), owner)
+        self._queue.put(key)
+        return True
+
+    def pending_for(self, path, title):
+        with self._lock:
+            items = [(k, d) for k, (p, d, _, _) in self._pending.items() if p == path and d.get("title") == title]
+        return sorted(items, key=lambda kd: kd[1].get("timestamp", ""))
+
+    def failed_for(self, path, title, owner):
+        with self._lock:
+            self._expire_failed()
+            return [(k, d) for k, ((p, d, _, o), _) in self._failed.items()
+                    if p == path and d.get("title") == title and o == owner]
+
+    def retry(self, key):
+        with self._lock:
+            failed = self._failed.pop(key, None)
+            if failed is None:
+                return False
+            self._pending[key] = failed[0]
+        self._queue.put(key)
+        return True
+
+    def discard(self, key):
+        with self._lock:
+            return self._failed.pop(key, None) is not None
+
+    def _expire_failed(self):
+        deadline = time.monotonic() - self.failed_ttl
+        for key in [k for k, (_, failed_at) in self._failed.items() if failed_at < deadline]:
+            logger.warning("書き込みキュー: 再送信されなかった投稿 %s を破棄しました", key)
+            del self._failed[key]
+
+    def _run(self):
+        while True:
+            keys = [self._queue.get()]
+            while len(keys) < self.max_batch:
+                try:
+                    keys.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(keys)
+            except Exception:
+                # ワーカーが止まると以後の返信がすべて「送信中」のまま残るので、ログだけ残して続ける
+                logger.exception("書き込みキュー: %d 件の処理中に予期しないエラーが発生しました", len(keys))
+
+    def _write(self, items):
+        # 投稿と集計（Increment を含む）を 1 つのトランザクションで書く。投稿ドキュメントが既にあるものは
+        # 前の試行で反映済みなので集計ごと飛ばし、再試行や再送信でカウンターが二重に加算されないようにする
+        from firebase_admin import firestore
+        refs = {key: self.client.collection(path).document(key) for key, (path, _, _, _) in items}
+
+        @firestore.transactional
+        def write(transaction):
+            existing = {snapshot.id for snapshot in self.client.get_all(list(refs.values()), transaction=transaction) if snapshot.exists}
+            for key, (_, data, extra, _) in items:
+                if key in existing:
+                    continue
+                transaction.set(refs[key], data)
+                for extra_path, doc_id, fields in extra:
+                    transaction.set(self.client.collection(extra_path).document(doc_id), fields, merge=True)
+
+        write(self.client.transaction())
+
+    def _write_with_retry(self, items):
+        for attempt in range(self.max_retries):
+            try:
+                self._write(items)
+                return
+            except Exception as exc:
+                if not is_transient_error(exc) or attempt == self.max_retries - 1:
+                    raise
+                delay = self.base_delay * (2 ** attempt)
+                logger.warning("書き込みキュー: %d 件の commit に失敗、%.1f 秒後に再試行します (%s)", len(items), delay, exc)
+                time.sleep(delay)
+
+    def _commit(self, keys):
+        with self._lock:
+            items = [(k, self._pending[k]) for k in keys if k in self._pending]
+        if not items:
+            return
+        try:
+            self._write_with_retry(items)
+            committed, failed = items, []
+        except Exception as exc:
+            if len(items) == 1:
+                committed, failed = [], items
+                logger.error("書き込みキュー: 投稿 %s を保存できませんでした", items[0][0], exc_info=exc)
+            else:
+                logger.warning("書き込みキュー: %d 件の一括 commit に失敗したため 1 件ずつ書き込みます (%s)", len(items), exc)
+                committed, failed = [], []
+                for item in items:
+                    try:
+                        self._write_with_retry([item])
+                        committed.append(item)
+                    except Exception as item_exc:
+                        logger.error("書き込みキュー: 投稿 %s を保存できませんでした", item[0], exc_info=item_exc)
+                        failed.append(item)
+        if failed:
+            now = time.monotonic()
+            with self._lock:
+                for key, entry in failed:
+                    self._failed[key] = (self._pending.pop(key, entry), now)
+        if not committed:
+            return
+        # キャッシュを先に消してから pending を外す（表示が一瞬消えるのを防ぐ）。
+        # on_commit が失敗しても commit 済みの投稿が pending に残らないよう、後始末は finally で行う
+        try:
+            if self.on_commit:
+                for path, title in {(path, data.get("title")) for _, (path, data, _, _) in committed}:
+                    self.on_commit(path, title)
+        finally:
+            with self._lock:
+                for key, _ in committed:
+                    self._pending.pop(key, None)
+                    self._done[key] = True
+                while len(self._done) > self.history:
+                    self._done.popitem(last=False)
+
+@st.cache_resource
+def get_write_queue(_db):
+    return WriteQueue(_db, on_commit=clear_question_cache)
+
+# ---------- 画像圧縮処理 ----------
+# OpenCV / NumPy は読み込みが重いので、画像を実際に処理するときに初めて import する
+def decode_image(file_bytes):
+    import cv2
+    import numpy as np
+    try:
+        img = cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except Exception:
+        st.error("画像の読み込みに失敗しました。")
+        return None
+    if img is None:
+        st.error("画像のデコードに失敗しました。")
+        return None
+    return img
+
+def process_image(img, max_size=1000000, max_width=800, initial_quality=95):
+    import cv2
+    height, width, _ = img.shape
+    if width > max_width:
+        ratio = max_width / width
+        new_width = max_width
+        new_height = int(height * ratio)
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    quality = initial_quality
+    while quality >= 10:
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        result, encimg = cv2.imencode('.jpg', img, encode_param)
+        if not result:
+            st.error("画像の圧縮に失敗しました。")
+            return None
+        size = encimg.nbytes
+        if size <= max_size:
+            return encimg.tobytes()
+        quality -= 5
+    st.error("画像の圧縮に失敗しました。")
+    return None
+
+def perceptual_hash(img, hash_size=16):
+    # dHash（256bit）＋縦横比。再保存・リサイズされた同一画像を同じキーにまとめる
+    import cv2
+    import numpy as np
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+    height, width = gray.shape
+    return f"{bits}_{round(width / height, 2)}"
+
+def same_image(img, stored_bytes, max_diff=48, mean_diff=4.0):
+    # 知覚ハッシュの一致は候補にすぎない（白紙とグレー、同じ書式の別のプリントなども一致しうる）。
+    # 保存済み画像を同じ大きさに揃え、ぼかした輝度の画素差が小さいときだけ同じ画像とみなす
+    import cv2
+    import numpy as np
+    stored = cv2.imdecode(np.frombuffer(stored_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if stored is None:
+        return False
+    height, width = stored.shape
+    gray = cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (width, height), interpolation=cv2.INTER_AREA)
+    diff = cv2.absdiff(cv2.GaussianBlur(gray, (5, 5), 0), cv2.GaussianBlur(stored, (5, 5), 0))
+    return int(diff.max()) <= max_diff and float(diff.mean()) <= mean_diff
+
+# ---------- 画像の重複排除 ----------
+# 画像は処理後 JPEG の SHA-256 を ID として images コレクションに一度だけ保存し、投稿には image_ref だけを持たせる。
+# アップロード元バイト列の SHA-256 と知覚ハッシュから image_ref を引く索引を、プロセス内 LRU と image_index コレクションに持つ。
+# SHA-256 が一致すればそのまま再利用し、知覚ハッシュの一致は画素を比べて確かめてから再利用する。
+# images ドキュメントの refs は参照している投稿の数。投稿と同じ batch / トランザクションで image_link() により加算し、
+# スレッドの完全削除（purge_thread）で減らして 0 になったら画像と索引を消す。
+class ImageRefCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._refs = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            ref = self._refs.get(key)
+            if ref is not None:
+                self._refs.move_to_end(key)
+            return ref
+
+    def put(self, key, ref):
+        with self._lock:
+            self._refs[key] = ref
+            self._refs.move_to_end(key)
+            while len(self._refs) > self.max_entries:
+                self._refs.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._refs.pop(key, None)
+
+@st.cache_resource
+def get_image_ref_cache():
+    return ImageRefCache()
+
+# prefix は course_prefix() の値。画像と索引はコースごとに分け、LRU のキーにも prefix を含める
+@st.cache_resource(max_entries=256)
+def fetch_image(_db, prefix, ref):
+    doc = _db.collection(prefix + "images").document(ref).get()
+    return doc.to_dict().get("data") if doc.exists else None
+
+def lookup_image_ref(db, prefix, key):
+    ref_cache = get_image_ref_cache()
+    ref = ref_cache.get(prefix + key)
+    if ref is None:
+        doc = db.collection(prefix + "image_index").document(key).get()
+        if doc.exists:
+            ref = doc.to_dict().get("ref")
+            ref_cache.put(prefix + key, ref)
+    return ref
+
+def store_image(db, prefix, image_file):
+    try:
+        image_file.seek(0)
+        file_bytes = image_file.read()
+    except Exception:
+        st.error("画像の読み込みに失敗しました。")
+        return None
+    raw_key = "sha256_" + hashlib.sha256(file_bytes).hexdigest()
+    ref = lookup_image_ref(db, prefix, raw_key)
+    if ref and image_exists(db, prefix, ref):
+        return ref
+    img = decode_image(file_bytes)
+    if img is None:
+        return None
+    phash_key = "dhash_" + perceptual_hash(img)
+    ref = lookup_image_ref(db, prefix, phash_key)
+    if ref:
+        stored_bytes = fetch_image(db, prefix, ref)
+        if stored_bytes is None or not same_image(img, stored_bytes) or not image_exists(db, prefix, ref):
+            ref = None
+    if not ref:
+        img_data = process_image(img)
+        if img_data is None:
+            return None
+        ref = hashlib.sha256(img_data).hexdigest()
+        image_doc = db.collection(prefix + "images").document(ref)
+        if not image_doc.get().exists:
+            image_doc.set({"data": img_data})
+    batch = db.batch()
+    for key in (raw_key, phash_key):
+        batch.set(db.collection(prefix + "image_index").document(key), {"ref": ref})
+        get_image_ref_cache().put(prefix + key, ref)
+    batch.commit()
+    return ref
+
+def image_exists(db, prefix, ref):
+    # 索引や LRU は別プロセスでの削除を知らないので、再利用する前に画像がまだあるかを確かめる
+    return db.collection(prefix + "images").document(ref).get().exists
+
+def image_link(prefix, ref):
+    # 投稿が画像を参照するときに、投稿と同じ batch / トランザクションで merge 書き込みする (コレクション, ドキュメントID, フィールド)
+    from firebase_admin import firestore
+    return (prefix + "images", ref, {"refs": firestore.Increment(1)})
+
+def release_image(db, prefix, ref):
+    # refs を 1 減らし、0 になったら画像と image_index の索引を消す。
+    # refs 導入前の画像は refs を持たないので、0 以下になったときは残っている投稿からの参照を数え直して確かめる
+    from firebase_admin import firestore
+    image_doc = db.collection(prefix + "images").document(ref)
+    referencing = db.collection(prefix + "questions").where("image_ref", "==", ref)
+    index_entries = db.collection(prefix + "image_index").where("ref", "==", ref)
+
+    @firestore.transactional
+    def release(transaction):
+        snapshot = image_doc.get(transaction=transaction)
+        if not snapshot.exists:
+            return []
+        refs = snapshot.to_dict().get("refs", 0) - 1
+        if refs <= 0:
+            refs = len(list(referencing.stream(transaction=transaction)))
+        if refs > 0:
+            transaction.update(image_doc, {"refs": refs})
+            return []
+        index_ids = [doc.id for doc in index_entries.stream(transaction=transaction)]
+        transaction.delete(image_doc)
+        for index_id in index_ids:
+            transaction.delete(db.collection(prefix + "image_index").document(index_id))
+        return index_ids
+
+    index_ids = release(db.transaction())
+    if index_ids:
+        for index_id in index_ids:
+            get_image_ref_cache().discard(prefix + index_id)
+        fetch_image.clear(None, prefix, ref)
+
+def purge_thread(db, prefix, title, messages):
+    # 両者が削除したスレッドを完全に消す。投稿と集計を消してから、投稿が参照していた画像の参照を外す
+    refs = [doc.image_ref for doc in messages if doc.image_ref]
+    for start in range(0, len(messages), 400):
+        batch = db.batch()
+        for doc in messages[start:start + 400]:
+            batch.delete(db.collection(prefix + "questions").document(doc.id))
+        batch.commit()
+    db.collection(prefix + "threads").document(thread_doc_id(title)).delete()
+    for ref in refs:
+        release_image(db, prefix, ref)
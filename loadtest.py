@@ -0,0 +1,568 @@
+"""forum.py / teacher.py の同時接続負荷試験ハーネス。
+
+ローカルのインメモリ Firestore（FakeBackend）に差し替えた上で、生徒・教師の
+セッションを streamlit.testing の AppTest として多数同時に走らせ、
+一覧閲覧・スレッド表示・返信・画像アップロードを行う。
+rerun レイテンシの p50/p95/p99、スループット、RSS、セッションあたりの読み取り数を表示する。
+
+例:
+    python loadtest.py --sessions 40 --concurrency 40 --actions 10 --mix browse=4,open=3,reply=2,upload=1
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import resource
+import sys
+import threading
+import time
+import types
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+STUDENT_PASSWORD = "student-pass"
+TEACHER_PASSWORD = "teacher-pass"
+AUTH_KEY = "loadtest"
+
+# ---------- インメモリ Firestore ----------
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return get_field(self._data or {}, field)
+
+def get_field(data, path):
+    for part in path.split("."):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+def apply_fields(current, data, merge):
+    target = dict(current) if (merge and current is not None) else {}
+    for path, value in data.items():
+        parts = path.split(".") if merge else [path]
+        node = target
+        for part in parts[:-1]:
+            node[part] = dict(node.get(part) or {})
+            node = node[part]
+        if isinstance(value, Increment):
+            value = (node.get(parts[-1]) or 0) + value.value
+        elif merge and isinstance(value, dict) and isinstance(node.get(parts[-1]), dict):
+            value = apply_fields(node[parts[-1]], value, merge)
+        node[parts[-1]] = value
+    return target
+
+class FakeBackend:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.collections = defaultdict(dict)
+        self.reads = 0
+        self.writes = 0
+        self._next_id = 0
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def new_id(self):
+        with self.lock:
+            self._next_id += 1
+            return f"auto{self._next_id:08d}"
+
+    def count_reads(self, n):
+        with self.lock:
+            self.reads += max(n, 1)
+
+    def write(self, path, doc_id, data, merge=False, update=False):
+        with self.lock:
+            docs = self.collections[path]
+            if update and doc_id not in docs:
+                raise KeyError(f"{path}/{doc_id} does not exist")
+            docs[doc_id] = apply_fields(docs.get(doc_id), data, merge or update)
+            self.writes += 1
+
+    def delete(self, path, doc_id):
+        with self.lock:
+            self.collections[path].pop(doc_id, None)
+            self.writes += 1
+
+class Query:
+    def __init__(self, backend, path, filters=(), orders=(), limit_count=None):
+        self.backend = backend
+        self.path = path
+        self.filters = tuple(filters)
+        self.orders = tuple(orders)
+        self.limit_count = limit_count
+
+    def where(self, field, op, value):
+        return Query(self.backend, self.path, self.filters + ((field, op, value),), self.orders, self.limit_count)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return Query(self.backend, self.path, self.filters, self.orders + ((field, direction),), self.limit_count)
+
+    def limit(self, count):
+        return Query(self.backend, self.path, self.filters, self.orders, count)
+
+    def stream(self, transaction=None):
+        ops = {
+            "==": lambda a, b: a == b,
+            "!=": lambda a, b: a != b,
+            "<": lambda a, b: a is not None and a < b,
+            "<=": lambda a, b: a is not None and a <= b,
+            ">": lambda a, b: a is not None and a > b,
+            ">=": lambda a, b: a is not None and a >= b,
+            "in": lambda a, b: a in b,
+        }
+        self.backend.wait()
+        with self.backend.lock:
+            items = list(self.backend.collections[self.path].items())
+        results = []
+        for doc_id, data in items:
+            if all(ops[op](get_field(data, field), value) for field, op, value in self.filters):
+                if all(get_field(data, field) is not None for field, _ in self.orders):
+                    results.append((doc_id, data))
+        for field, direction in reversed(self.orders):
+            results.sort(key=lambda item: get_field(item[1], field), reverse=(direction == "DESCENDING"))
+        if self.limit_count is not None:
+            results = results[:self.limit_count]
+        self.backend.count_reads(len(results))
+        collection = CollectionReference(self.backend, self.path)
+        return iter([DocumentSnapshot(collection.document(doc_id), data) for doc_id, data in results])
+
+    def get(self):
+        return list(self.stream())
+
+class CollectionReference(Query):
+    def __init__(self, backend, path):
+        super().__init__(backend, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id=None):
+        return DocumentReference(self.backend, self.path, doc_id or self.backend.new_id())
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+class DocumentReference:
+    def __init__(self, backend, path, doc_id):
+        self.backend = backend
+        self.parent_path = path
+        self.id = doc_id
+        self.path = f"{path}/{doc_id}"
+
+    def collection(self, name):
+        return CollectionReference(self.backend, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        self.backend.wait()
+        self.backend.count_reads(1)
+        with self.backend.lock:
+            data = self.backend.collections[self.parent_path].get(self.id)
+        return DocumentSnapshot(self, dict(data) if data is not None else None)
+
+    def set(self, data, merge=False):
+        self.backend.wait()
+        self.backend.write(self.parent_path, self.id, data, merge=merge)
+
+    def update(self, data):
+        self.backend.wait()
+        self.backend.write(self.parent_path, self.id, data, update=True)
+
+    def delete(self):
+        self.backend.wait()
+        self.backend.delete(self.parent_path, self.id)
+
+class WriteBatch:
+    def __init__(self, backend):
+        self.backend = backend
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append(("set", ref, data, merge))
+
+    def update(self, ref, data):
+        self.ops.append(("update", ref, data, True))
+
+    def delete(self, ref):
+        self.ops.append(("delete", ref, None, False))
+
+    def commit(self):
+        self.backend.wait()
+        with self.backend.lock:
+            for kind, ref, data, merge in self.ops:
+                if kind == "delete":
+                    self.backend.delete(ref.parent_path, ref.id)
+                else:
+                    self.backend.write(ref.parent_path, ref.id, data, merge=merge, update=(kind == "update"))
+        self.ops = []
+
+class Transaction(WriteBatch):
+    pass
+
+def transactional(func):
+    # 関数の実行中はバックエンドのロックを握るので、読み取りから commit までが他の書き込みと直列化される
+    def run(transaction, *args, **kwargs):
+        with transaction.backend.lock:
+            result = func(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return run
+
+class FakeClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def collection(self, path):
+        return CollectionReference(self.backend, path)
+
+    def batch(self):
+        return WriteBatch(self.backend)
+
+    def transaction(self):
+        return Transaction(self.backend)
+
+    def get_all(self, references, transaction=None):
+        return iter([ref.get(transaction=transaction) for ref in references])
+
+def install_fake_firebase(backend):
+    # forum.py / teacher.py の import firebase_admin をインメモリ実装に差し替える
+    firebase_admin = types.ModuleType("firebase_admin")
+    credentials = types.ModuleType("firebase_admin.credentials")
+    firestore = types.ModuleType("firebase_admin.firestore")
+    firebase_admin._apps = {}
+    firebase_admin.initialize_app = lambda cred=None, *args, **kwargs: firebase_admin._apps.setdefault("[DEFAULT]", cred)
+    credentials.Certificate = lambda source: source
+    client = FakeClient(backend)
+    firestore.client = lambda *args, **kwargs: client
+    firestore.Query = types.SimpleNamespace(ASCENDING="ASCENDING", DESCENDING="DESCENDING")
+    firestore.Increment = Increment
+    firestore.transactional = transactional
+    firebase_admin.credentials = credentials
+    firebase_admin.firestore = firestore
+    sys.modules["firebase_admin"] = firebase_admin
+    sys.modules["firebase_admin.credentials"] = credentials
+    sys.modules["firebase_admin.firestore"] = firestore
+
+def share_apptest_runtime():
+    # AppTest.run() は実行ごとに Runtime._instance を差し替えて最後に None に戻すため、
+    # 複数セッションを並行させると他スレッドの実行中に Runtime が消える。最初の Runtime を共有させる。
+    # スクリプトのバイトコードも実サーバーと同様にプロセスで 1 回だけコンパイルする。
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    shared = []
+    original = Runtime.instance.__func__
+
+    def instance(cls):
+        if not shared and cls._instance is not None:
+            shared.append(cls._instance)
+        return shared[0] if shared else original(cls)
+
+    Runtime.instance = classmethod(instance)
+
+# ---------- テストデータ ----------
+def make_images(count, seed):
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        img = rng.integers(0, 255, size=(600, 900, 3), dtype=np.uint8)
+        img = cv2.GaussianBlur(img, (31, 31), 0)
+        ok, buf = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        images.append(buf.tobytes())
+    return images
+
+def seed_backend(backend, threads, messages, path="questions"):
+    # スレッド集計（teacher.py の threads コレクション）も書き込み時と同じ形で用意する
+    client = FakeClient(backend)
+    threads_path = path[:-len("questions")] + "threads"
+    base = datetime(2025, 4, 1, 9, 0, 0)
+    titles = []
+    for t in range(threads):
+        title = f"負荷試験スレッド{t:04d}"
+        titles.append(title)
+        for m in range(messages):
+            timestamp = (base + timedelta(minutes=t * messages + m)).strftime("%Y-%m-%d %H:%M:%S")
+            data = {
+                "title": title,
+                "question": f"質問本文 {t}-{m}" if m % 3 else f"[先生] 回答 {t}-{m}",
+                "image": None,
+                "timestamp": timestamp,
+                "deleted": 0,
+                "poster": f"生徒{t:04d}",
+            }
+            if m == 0:
+                data["question"] = f"質問本文 {t}-0"
+                data["auth_key"] = AUTH_KEY
+            client.collection(path).document().set(data)
+            stats = {"title": title, "updated_at": timestamp}
+            if data["question"].startswith("[先生]"):
+                stats.update({"unanswered": 0, "needs_reply": False, "last_teacher_at": timestamp})
+            else:
+                stats.update({"unanswered": Increment(1), "needs_reply": True, "student_count": Increment(1), "last_student_at": timestamp})
+            if m == 0:
+                stats.update({"poster": data["poster"], "auth_key": AUTH_KEY, "teacher_deleted": False})
+            client.collection(threads_path).document(hashlib.sha1(title.encode("utf-8")).hexdigest()).set(stats, merge=True)
+    backend.reads = 0
+    backend.writes = 0
+    return titles
+
+# ---------- セッション ----------
+class Session:
+    def __init__(self, role, script, rng, images, timeout, course=None, courses=None):
+        from streamlit.testing.v1 import AppTest
+        self.role = role
+        self.rng = rng
+        self.images = images
+        self.at = AppTest.from_file(script, default_timeout=timeout)
+        self.at.secrets["student"] = {"password": STUDENT_PASSWORD}
+        self.at.secrets["teacher"] = {"password": TEACHER_PASSWORD}
+        if courses:
+            self.at.secrets["courses"] = courses
+            self.at.query_params["course"] = course
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self.in_thread = False
+
+    def run(self, action):
+        start = time.perf_counter()
+        self.at.run()
+        self.latencies[action].append(time.perf_counter() - start)
+        if self.at.exception:
+            self.errors += 1
+
+    def button(self, key=None, label=None):
+        for button in self.at.button:
+            if key is not None and button.key == key:
+                return button
+            if label is not None and button.label == label:
+                return button
+        return None
+
+    def login(self):
+        self.run("initial")
+        self.at.text_input[0].input(STUDENT_PASSWORD if self.role == "student" else TEACHER_PASSWORD)
+        self.button(key="student_login" if self.role == "student" else "teacher_login").click()
+        self.run("login")
+
+    def back_to_list(self):
+        if self.in_thread:
+            back = self.button(key="chat_back")
+            if back is not None:
+                back.click()
+                self.run("back")
+            self.in_thread = False
+
+    def browse(self):
+        self.back_to_list()
+        if self.role == "teacher" and self.at.selectbox:
+            self.at.selectbox(key="teacher_sort_mode").select("最終更新順")
+            self.at.checkbox(key="teacher_only_unanswered").uncheck()
+        refresh = self.button(key="title_update" if self.role == "student" else "teacher_title_update")
+        if refresh is not None:
+            refresh.click()
+        self.run("browse")
+
+    def triage(self):
+        # 教師は集計カウンターで未回答スレッドを絞り込む。生徒は一覧の更新と同じ
+        self.back_to_list()
+        if self.role != "teacher":
+            self.browse()
+            return
+        self.at.selectbox(key="teacher_sort_mode").select(self.rng.choice(["未回答の多い順", "生徒の最終投稿が新しい順", "未読の多い順（取得後に並び替え）"]))
+        self.at.checkbox(key="teacher_only_unanswered").check()
+        self.run("triage")
+
+    def title_buttons(self):
+        # 一覧のスレッドボタン（title_button_<n> / teacher_title_<n>）だけを返す。
+        # 同じ接頭辞を持つ「更新」ボタン teacher_title_update は含めない
+        prefix = "title_button_" if self.role == "student" else "teacher_title_"
+        return [b for b in self.at.button if b.key and b.key.startswith(prefix) and b.key[len(prefix):].isdigit()]
+
+    def open_thread(self):
+        self.back_to_list()
+        candidates = self.title_buttons()
+        if not candidates:
+            return
+        self.rng.choice(candidates).click()
+        self.run("open")
+        if self.role == "student":
+            auth_inputs = [t for t in self.at.text_input if t.label == "認証キーを入力"]
+            submit = self.button(label="認証する")
+            if not auth_inputs or submit is None:
+                return
+            auth_inputs[0].input(AUTH_KEY)
+            submit.click()
+            self.run("auth")
+        self.in_thread = self.button(key="chat_back") is not None
+
+    def reply(self, with_image=False):
+        if not self.in_thread:
+            self.open_thread()
+        if not self.in_thread or not self.at.text_area:
+            return
+        self.at.text_area[0].input(f"負荷試験の返信 {self.rng.random():.6f}")
+        if with_image and self.at.file_uploader:
+            self.at.file_uploader[0].set_value(("photo.jpg", self.rng.choice(self.images), "image/jpeg"))
+        self.button(label="送信").click()
+        self.run("upload" if with_image else "reply")
+
+    def perform(self, action):
+        if action == "browse":
+            self.browse()
+        elif action == "open":
+            self.open_thread()
+        elif action == "reply":
+            self.reply()
+        elif action == "upload":
+            self.reply(with_image=True)
+        elif action == "triage":
+            self.triage()
+
+def run_session(index, args, mix, images):
+    rng = random.Random(args.seed + index)
+    role = "teacher" if rng.random() < args.teacher_ratio else "student"
+    script = args.teacher_script if role == "teacher" else args.student_script
+    courses = course_secrets(args.courses)
+    course = f"course{index % args.courses:02d}" if args.courses else None
+    session = Session(role, script, rng, images, args.timeout, course, courses)
+    session.login()
+    actions, weights = zip(*mix.items())
+    for _ in range(args.actions):
+        session.perform(rng.choices(actions, weights)[0])
+        if args.think_time:
+            time.sleep(rng.uniform(0, args.think_time))
+    return session
+
+def course_secrets(count):
+    return {
+        f"course{i:02d}": {"name": f"コース{i:02d}", "student_password": STUDENT_PASSWORD, "teacher_password": TEACHER_PASSWORD}
+        for i in range(count)
+    }
+
+# ---------- 集計 ----------
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    # nearest-rank 法
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def rss_mb():
+    # Linux では ru_maxrss は KB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ("browse", "open", "reply", "upload", "triage"):
+            raise argparse.ArgumentTypeError(f"unknown action: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生徒・教師セッションの同時負荷試験")
+    parser.add_argument("--sessions", type=int, default=20, help="シミュレートするセッション数")
+    parser.add_argument("--concurrency", type=int, default=20, help="同時に実行するセッション数")
+    parser.add_argument("--actions", type=int, default=10, help="ログイン後に各セッションが行う操作数")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("browse=4,open=3,reply=2,upload=1,triage=1"),
+                        help="操作の重み (browse,open,reply,upload,triage)")
+    parser.add_argument("--teacher-ratio", type=float, default=0.1, help="教師セッションの割合")
+    parser.add_argument("--threads", type=int, default=50, help="事前投入するスレッド数")
+    parser.add_argument("--courses", type=int, default=0, help="コース数（0 なら単一の questions コレクション）")
+    parser.add_argument("--messages", type=int, default=10, help="スレッドあたりの事前投入メッセージ数")
+    parser.add_argument("--images", type=int, default=5, help="アップロードに使う画像の種類数")
+    parser.add_argument("--backend-latency", type=float, default=20.0, help="Firestore 呼び出し 1 回あたりの遅延 (ms)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="操作間の最大待ち時間 (秒)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1 回の rerun のタイムアウト (秒)")
+    parser.add_argument("--student-script", default="forum.py")
+    parser.add_argument("--teacher-script", default="teacher.py")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    args = parser.parse_args(argv)
+
+    backend = FakeBackend(latency=args.backend_latency / 1000)
+    install_fake_firebase(backend)
+    share_apptest_runtime()
+    if args.courses:
+        for course in course_secrets(args.courses):
+            seed_backend(backend, args.threads, args.messages, f"courses/{course}/questions")
+    else:
+        seed_backend(backend, args.threads, args.messages)
+    images = make_images(args.images, args.seed)
+    rss_before = rss_mb()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        sessions = list(pool.map(lambda i: run_session(i, args, args.mix, images), range(args.sessions)))
+    elapsed = time.perf_counter() - start
+
+    by_action = defaultdict(list)
+    for session in sessions:
+        for action, values in session.latencies.items():
+            by_action[action].extend(values)
+    all_latencies = [v for values in by_action.values() for v in values]
+    report = {
+        "sessions": args.sessions,
+        "students": sum(s.role == "student" for s in sessions),
+        "teachers": sum(s.role == "teacher" for s in sessions),
+        "reruns": len(all_latencies),
+        "errors": sum(s.errors for s in sessions),
+        "elapsed_s": elapsed,
+        "throughput_reruns_per_s": len(all_latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            action: {
+                "count": len(values),
+                "p50": percentile(values, 50) * 1000,
+                "p95": percentile(values, 95) * 1000,
+                "p99": percentile(values, 99) * 1000,
+            }
+            for action, values in sorted(by_action.items()) + [("all", all_latencies)]
+        },
+        "rss_mb": {"before": rss_before, "peak": rss_mb()},
+        "backend_reads": backend.reads,
+        "backend_writes": backend.writes,
+        "reads_per_session": backend.reads / args.sessions if args.sessions else 0.0,
+    }
+
+    print(f"sessions: {report['sessions']} (生徒 {report['students']} / 教師 {report['teachers']}), "
+          f"reruns: {report['reruns']}, errors: {report['errors']}")
+    print(f"elapsed: {elapsed:.2f}s, throughput: {report['throughput_reruns_per_s']:.1f} reruns/s")
+    print(f"{'action':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for action, stats in report["latency_ms"].items():
+        print(f"{action:<10}{stats['count']:>8}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}")
+    print(f"RSS: {report['rss_mb']['before']:.1f} MB -> peak {report['rss_mb']['peak']:.1f} MB")
+    print(f"backend reads: {backend.reads} ({report['reads_per_session']:.1f}/session), writes: {backend.writes}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+if __name__ == "__main__":
+    main()
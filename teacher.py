@@ -2,80 +2,97 @@ import streamlit as st
 import base64
 from datetime import datetime
 from zoneinfo import ZoneInfo
-import firebase_admin
-from firebase_admin import credentials, firestore
 import ast
-import cv2
-import numpy as np
+import uuid
+from forum_common import DEFAULT_COURSE, course_name, course_password, course_prefix, select_course
+from forum_common import thread_doc_id, delete_message, thread_stats_from_messages, teacher_post_stats, fetch_thread_stats, clear_thread_stats_cache, get_write_queue
+from forum_common import to_message, fetch_image, store_image, image_link, purge_thread, fetch_all_questions, fetch_questions_by_title, clear_question_cache
 
 # ---------- 教師ログイン ----------
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 if not st.session_state.authenticated:
     st.title("教師ログイン")
+    course_id = select_course()
     password = st.text_input("パスワードを入力", type="password")
+    teacher_name = st.text_input("教師名（未読の管理に使います）", value="先生")
     if st.button("ログイン", key="teacher_login"):
-        if password == st.secrets["teacher"]["password"]:
+        expected_password = course_password(course_id, "teacher")
+        if expected_password is None:
+            st.error("このコースのパスワードが設定されていません。")
+        elif password == expected_password:
             st.session_state.authenticated = True
+            st.session_state.teacher_name = teacher_name.strip() or "先生"
+            st.session_state.course = course_id
+            st.session_state.course_prefix = course_prefix(course_id)
+            st.session_state.course_name = course_name(course_id)
             st.session_state.is_authenticated = True
             st.rerun()
         else:
             st.error("パスワードが違います。")
     st.stop()
 
-# ---------- 画像圧縮処理 ----------
-def process_image(image_file, max_size=1000000, max_width=800, initial_quality=95):
-    try:
-        image_file.seek(0)
-        file_bytes = np.asarray(bytearray(image_file.read()), dtype=np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-    except Exception as e:
-        st.error("画像の読み込みに失敗しました。")
-        return None
-    if img is None:
-        st.error("画像のデコードに失敗しました。")
-        return None
-    height, width, _ = img.shape
-    if width > max_width:
-        ratio = max_width / width
-        new_width = max_width
-        new_height = int(height * ratio)
-        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-    quality = initial_quality
-    while quality >= 10:
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-        result, encimg = cv2.imencode('.jpg', img, encode_param)
-        if not result:
-            st.error("画像の圧縮に失敗しました。")
-            return None
-        size = encimg.nbytes
-        if size <= max_size:
-            return encimg.tobytes()
-        quality -= 5
-    st.error("画像の圧縮に失敗しました。")
-    return None
-
 # ---------- Firestore 初期化 ----------
-if not firebase_admin._apps:
-    try:
-        firebase_creds = st.secrets["firebase"]
-        if isinstance(firebase_creds, str):
-            firebase_creds = ast.literal_eval(firebase_creds)
-        elif not isinstance(firebase_creds, dict):
-            firebase_creds = dict(firebase_creds)
-        cred = credentials.Certificate(firebase_creds)
-    except KeyError:
-        cred = credentials.Certificate("serviceAccountKey.json")
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+# 認証情報の解析とクライアント生成はプロセスで 1 回だけ行い、rerun ごとには繰り返さない
+@st.cache_resource
+def get_db():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    if not firebase_admin._apps:
+        try:
+            firebase_creds = st.secrets["firebase"]
+            if isinstance(firebase_creds, str):
+                firebase_creds = ast.literal_eval(firebase_creds)
+            elif not isinstance(firebase_creds, dict):
+                firebase_creds = dict(firebase_creds)
+            cred = credentials.Certificate(firebase_creds)
+        except KeyError:
+            cred = credentials.Certificate("serviceAccountKey.json")
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+db = get_db()
 
-# ---------- キャッシュ付き Firestore アクセス ----------
-@st.cache_resource(ttl=10)
-def fetch_all_questions():
-    return list(db.collection("questions").order_by("timestamp", direction=firestore.Query.DESCENDING).stream())
-@st.cache_resource(ttl=10)
-def fetch_questions_by_title(title):
-    return list(db.collection("questions").where("title", "==", title).order_by("timestamp").stream())
+# ---------- 現在のコースのコレクション ----------
+collection_prefix = st.session_state.get("course_prefix", "")
+questions_path = collection_prefix + "questions"
+threads_path = collection_prefix + "threads"
+
+# ---------- スレッド集計 ----------
+# 並び替えの値は forum_common.THREAD_ORDER_FIELDS のいずれか（None は従来の全件集計）
+SORT_ORDERS = {
+    "最終更新順": None,
+    "未回答の多い順": "unanswered",
+    "生徒の最終投稿が新しい順": "last_student_at",
+    # 未読数は教師ごとに違い Firestore のクエリでは並び替えられないので、更新順に取得してから画面側で並び替える
+    "未読の多い順（取得後に並び替え）": "updated_at",
+}
+
+def mark_thread_read(title):
+    teacher_name = st.session_state.get("teacher_name", "先生")
+    ref = db.collection(threads_path).document(thread_doc_id(title))
+    snapshot = ref.get()
+    if not snapshot.exists:
+        return
+    stats = snapshot.to_dict()
+    if stats.get("read", {}).get(teacher_name) != stats.get("student_count", 0):
+        ref.set({"read": {teacher_name: stats.get("student_count", 0)}}, merge=True)
+        clear_thread_stats_cache(threads_path)
+
+def rebuild_thread_stats():
+    # カウンター導入前のスレッドや不整合を、全メッセージから一度だけ再計算する（既読情報は残す）
+    clear_question_cache(questions_path)
+    stats = thread_stats_from_messages(fetch_all_questions(db, questions_path))
+    # student_count は既読位置と比べる累計なので、保存済みの値より小さくしない
+    stored_counts = {doc.to_dict().get("title"): doc.to_dict().get("student_count", 0) for doc in db.collection(threads_path).stream()}
+    for title, entry in stats.items():
+        entry["student_count"] = max(entry["student_count"], stored_counts.get(title, 0))
+    items = list(stats.items())
+    for start in range(0, len(items), 400):
+        batch = db.batch()
+        for title, entry in items[start:start + 400]:
+            batch.set(db.collection(threads_path).document(thread_doc_id(title)), entry, merge=True)
+        batch.commit()
+    clear_thread_stats_cache(threads_path)
 
 # ---------- Session State 初期化（教師用）----------
 if "selected_title" not in st.session_state:
@@ -86,27 +103,26 @@ if "deleted_titles_teacher" not in st.session_state:
     st.session_state.deleted_titles_teacher = []
 if "pending_delete_msg_id" not in st.session_state:
     st.session_state.pending_delete_msg_id = None
+if "reply_idempotency_key" not in st.session_state:
+    st.session_state.reply_idempotency_key = uuid.uuid4().hex
+if "writer_id" not in st.session_state:
+    st.session_state.writer_id = uuid.uuid4().hex
 
 #####################################
 # 質問一覧の表示（教師用）
 #####################################
-def show_title_list():
-    st.title("📖 質問フォーラム（教師用）")
-    st.subheader("質問一覧")
-    keyword_input = st.text_input("キーワード検索")
-    keywords = [w.strip().lower() for w in keyword_input.split() if w.strip()] if keyword_input else []
-    docs = fetch_all_questions()
-    teacher_deleted_titles = {doc.to_dict().get("title") for doc in docs 
-                              if doc.to_dict().get("question", "").startswith("[SYSTEM]先生は質問フォームを削除しました")}
+def titles_from_messages():
+    docs = fetch_all_questions(db, questions_path)
+    teacher_deleted_titles = {doc.title for doc in docs 
+                              if doc.question.startswith("[SYSTEM]先生は質問フォームを削除しました")}
     title_info = {}
     for doc in docs:
-        data = doc.to_dict()
-        if data.get("question", "").startswith("[SYSTEM]"):
+        if doc.kind == "system":
             continue
-        title = data.get("title")
-        poster = data.get("poster") or "匿名"
-        auth_key = data.get("auth_key", "")
-        timestamp = data.get("timestamp", "")
+        title = doc.title
+        poster = doc.poster
+        auth_key = doc.auth_key
+        timestamp = doc.timestamp
         if title in title_info:
             if timestamp < title_info[title]["orig_timestamp"]:
                 title_info[title]["orig_timestamp"] = timestamp
@@ -131,12 +147,48 @@ def show_title_list():
             "auth_key": info["auth_key"],
             "update": info["update"]
         })
+    return distinct_titles
+
+def titles_from_stats(order_field, only_unanswered):
+    teacher_name = st.session_state.get("teacher_name", "先生")
+    distinct_titles = []
+    for stats in fetch_thread_stats(db, threads_path, order_field, only_unanswered):
+        if stats.get("teacher_deleted") or stats["title"] in st.session_state.deleted_titles_teacher:
+            continue
+        distinct_titles.append({
+            "title": stats["title"],
+            "poster": stats.get("poster") or "匿名",
+            "auth_key": stats.get("auth_key", ""),
+            "update": stats.get("updated_at", ""),
+            "unanswered": stats.get("unanswered", 0),
+            "unread": max(stats.get("student_count", 0) - stats.get("read", {}).get(teacher_name, 0), 0)
+        })
+    return distinct_titles
+
+def show_title_list():
+    st.title("📖 質問フォーラム（教師用）")
+    if st.session_state.get("course", DEFAULT_COURSE) != DEFAULT_COURSE:
+        st.caption(f"コース: {st.session_state.course_name}")
+    st.subheader("質問一覧")
+    keyword_input = st.text_input("キーワード検索")
+    keywords = [w.strip().lower() for w in keyword_input.split() if w.strip()] if keyword_input else []
+    sort_mode = st.selectbox("並び替え", list(SORT_ORDERS), key="teacher_sort_mode")
+    only_unanswered = st.checkbox("未回答のみ表示", key="teacher_only_unanswered")
+    if sort_mode == "未読の多い順（取得後に並び替え）":
+        st.caption("未読数は教師ごとに異なるため、スレッドを更新順に取得したあと画面上で未読の多い順に並び替えています。")
+    if SORT_ORDERS[sort_mode] is None and not only_unanswered:
+        distinct_titles = titles_from_messages()
+    else:
+        distinct_titles = titles_from_stats(SORT_ORDERS[sort_mode] or "updated_at", only_unanswered)
     if keywords:
         def match(item):
             text = (item["title"] + " " + item["poster"]).lower()
             return all(kw in text for kw in keywords)
         distinct_titles = [item for item in distinct_titles if match(item)]
-    distinct_titles.sort(key=lambda x: x["update"], reverse=True)
+    if sort_mode == "最終更新順":
+        distinct_titles.sort(key=lambda x: x["update"], reverse=True)
+    elif sort_mode == "未読の多い順（取得後に並び替え）":
+        distinct_titles.sort(key=lambda x: x["unread"], reverse=True)
     if not distinct_titles:
         st.write("現在、質問はありません。")
     else:
@@ -148,7 +200,10 @@ def show_title_list():
                 update_time = item["update"]
                 cols = st.columns([8, 2])
                 label = f"{title}\n(投稿者: {poster}, 認証コード: {auth_code})\n最終更新: {update_time}"
+                if "unanswered" in item:
+                    label += f"\n未回答: {item['unanswered']} / 未読: {item['unread']}"
                 if cols[0].button(label, key=f"teacher_title_{idx}"):
+                    mark_thread_read(title)
                     st.session_state.selected_title = title
                     st.rerun()
                 if cols[1].button("🗑", key=f"teacher_del_{idx}"):
@@ -163,15 +218,14 @@ def show_title_list():
                         with col2:
                             cancel_del = st.form_submit_button("キャンセル")
                     if submit_del:
-                        docs = fetch_questions_by_title(title)
+                        docs = fetch_questions_by_title(db, questions_path, title)
                         if docs:
-                            data0 = docs[0].to_dict()
-                            poster_name = data0.get("poster") or "匿名"
+                            poster_name = docs[0].poster
                         else:
                             poster_name = "匿名"
                         st.session_state.deleted_titles_teacher.append(title)
                         time_str = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S")
-                        db.collection("questions").add({
+                        db.collection(questions_path).add({
                             "title": title,
                             "question": "[SYSTEM]先生は質問フォームを削除しました",
                             "timestamp": time_str,
@@ -180,29 +234,33 @@ def show_title_list():
                             "poster": poster_name,
                             "auth_key": item["auth_key"]
                         })
+                        db.collection(threads_path).document(thread_doc_id(title)).set({"teacher_deleted": True}, merge=True)
                         st.success(f"タイトル「{title}」を削除しました。")
-                        st.cache_resource.clear()
-                        docs_for_title = fetch_questions_by_title(title)
+                        clear_question_cache(questions_path, title)
+                        docs_for_title = fetch_questions_by_title(db, questions_path, title)
                         student_deleted = any(
-                            doc.to_dict().get("question", "").startswith("[SYSTEM]生徒はこの質問フォームを削除しました")
+                            doc.question.startswith("[SYSTEM]生徒はこの質問フォームを削除しました")
                             for doc in docs_for_title
                         )
                         teacher_deleted = any(
-                            doc.to_dict().get("question", "").startswith("[SYSTEM]先生は質問フォームを削除しました")
+                            doc.question.startswith("[SYSTEM]先生は質問フォームを削除しました")
                             for doc in docs_for_title
                         )
                         if student_deleted and teacher_deleted:
-                            for doc in docs_for_title:
-                                db.collection("questions").document(doc.id).delete()
+                            purge_thread(db, collection_prefix, title, list(docs_for_title))
                             st.success("両者による削除が確認されたため、データベースから完全に削除しました。")
-                        st.cache_resource.clear()
+                        clear_question_cache(questions_path, title)
                         st.rerun()
                     elif cancel_del:
                         st.session_state.pending_delete_title = None
                         st.rerun()
     if st.button("更新", key="teacher_title_update"):
-        st.cache_resource.clear()
+        clear_question_cache(questions_path)
         st.rerun()
+    if SORT_ORDERS[sort_mode] is not None or only_unanswered:
+        if st.button("集計を再計算", key="teacher_rebuild_stats"):
+            rebuild_thread_stats()
+            st.rerun()
 
 #####################################
 # 質問詳細（チャットスレッド）の表示（教師用）
@@ -226,41 +284,27 @@ def show_chat_thread():
         """,
         unsafe_allow_html=True
     )
-    docs = fetch_questions_by_title(selected_title)
-    first_question_poster = "匿名"
-    if docs:
-        first_question = docs[0].to_dict()
-        first_question_poster = first_question.get("poster", "匿名")
-    sys_msgs = [doc.to_dict() for doc in docs if doc.to_dict().get("question", "").startswith("[SYSTEM]")]
+    docs = fetch_questions_by_title(db, questions_path, selected_title)
+    first_question_poster = docs[0].poster if docs else "匿名"
+    sys_msgs = [doc for doc in docs if doc.kind == "system"]
     if sys_msgs:
         for sys_msg in sys_msgs:
-            text = sys_msg.get("question", "")[8:]
-            st.markdown(f"<h3 style='color: red; text-align: center;'>{text}</h3>", unsafe_allow_html=True)
-    records = [doc for doc in docs if not doc.to_dict().get("question", "").startswith("[SYSTEM]")]
+            st.markdown(f"<h3 style='color: red; text-align: center;'>{sys_msg.text}</h3>", unsafe_allow_html=True)
+    records = [doc for doc in docs if doc.kind != "system"]
     if not records:
         st.write("該当する質問が見つかりません。")
         return
     for doc in records:
-        data = doc.to_dict()
-        msg_text = data.get("question", "")
-        msg_time = data.get("timestamp", "")
-        poster = data.get("poster") or "匿名"
-        deleted = data.get("deleted", 0)
-        try:
-            formatted_time = datetime.strptime(msg_time, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M")
-        except Exception:
-            formatted_time = msg_time
-        if deleted:
+        if doc.deleted:
             st.markdown("<div style='color: red;'>【投稿が削除されました】</div>", unsafe_allow_html=True)
             continue
-        if msg_text.startswith("[先生]"):
+        msg_display = doc.text
+        if doc.kind == "teacher":
             sender = "先生"
-            msg_display = msg_text[len("[先生]"):].strip()
             align = "right"
             bg_color = "#DCF8C6"  # 先生は緑緑背景
         else:
-            sender = poster
-            msg_display = msg_text
+            sender = doc.poster
             align = "left"
             bg_color = "#FFFFFF"  # 生徒は白白背景
         st.markdown(
@@ -274,14 +318,15 @@ def show_chat_thread():
                   max-width: 80%;
                   word-wrap: break-word;">
                 <b>{sender}:</b> {msg_display}<br>
-                <small>({formatted_time})</small>
+                <small>({doc.display_time})</small>
               </div>
             </div>
             """,
             unsafe_allow_html=True
         )
-        if "image" in data and data["image"]:
-            img_data = base64.b64encode(data["image"]).decode("utf-8")
+        image_bytes = doc.image or (fetch_image(db, collection_prefix, doc.image_ref) if doc.image_ref else None)
+        if image_bytes:
+            img_data = base64.b64encode(image_bytes).decode("utf-8")
             # 画像の配置は、チャットの寄せに合わせる
             align_style = "margin-left: auto;" if align=="right" else "margin-right: auto;"
             st.markdown(
@@ -295,7 +340,7 @@ def show_chat_thread():
         st.markdown("<div style='margin-bottom: 20px;'></div>", unsafe_allow_html=True)
         
                 # 生徒側は自分の投稿（[先生]以外）に対して削除ボタンを表示
-        if st.session_state.is_authenticated and ((msg_text.strip() != "") or data.get("image")) and msg_text.startswith("[先生]"):
+        if st.session_state.is_authenticated and ((doc.question.strip() != "") or doc.image or doc.image_ref) and doc.kind == "teacher":
             if st.button("🗑", key=f"del_{doc.id}"):
                 st.session_state.pending_delete_msg_id = doc.id
                 st.rerun()
@@ -303,15 +348,57 @@ def show_chat_thread():
                 st.warning("本当にこの投稿を削除しますか？")
                 confirm_col1, confirm_col2 = st.columns(2)
                 if confirm_col1.button("はい", key=f"confirm_delete_{doc.id}"):
-                    d_ref = db.collection("questions").document(doc.id)
-                    d_ref.update({"deleted": 1})
+                    delete_message(db, questions_path, threads_path, selected_title, doc.id)
                     st.session_state.pending_delete_msg_id = None
-                    st.cache_resource.clear()
                     st.rerun()
                 if confirm_col2.button("キャンセル", key=f"cancel_delete_{doc.id}"):
                     st.session_state.pending_delete_msg_id = None
                     st.rerun()
     
+    # 送信中（キュー内）の返信を楽観的に表示する
+    write_queue = get_write_queue(db)
+    committed_ids = {doc.id for doc in docs}
+    queued = [(key, data, "送信中...") for key, data in write_queue.pending_for(questions_path, selected_title)]
+    queued += [(key, data, "送信に失敗しました") for key, data in write_queue.failed_for(questions_path, selected_title, st.session_state.writer_id)]
+    for key, data, status in queued:
+        if key in committed_ids:
+            continue
+        msg = to_message(key, data)
+        msg_display = msg.text
+        if msg.kind == "teacher":
+            sender = "先生"
+            align = "right"
+            bg_color = "#DCF8C6"
+        else:
+            sender = msg.poster
+            align = "left"
+            bg_color = "#FFFFFF"
+        st.markdown(
+            f"""
+            <div style="text-align: {align}; margin-bottom: 15px; opacity: 0.6;">
+              <div style="
+                  display: inline-block;
+                  background-color: {bg_color};
+                  padding: 10px;
+                  border-radius: 10px;
+                  max-width: 80%;
+                  word-wrap: break-word;">
+                <b>{sender}:</b> {msg_display}<br>
+                <small>({status})</small>
+              </div>
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+        if status == "送信に失敗しました":
+            retry_col, discard_col = st.columns(2)
+            if retry_col.button("再送信", key=f"retry_{key}"):
+                write_queue.retry(key)
+                st.rerun()
+            if discard_col.button("破棄", key=f"discard_{key}"):
+                write_queue.discard(key)
+                st.rerun()
+
     st.markdown("<div id='latest_message'></div>", unsafe_allow_html=True)
     st.markdown(
         """
@@ -326,7 +413,7 @@ def show_chat_thread():
     )
    
     if st.button("更新", key="chat_update"):
-        st.cache_resource.clear()
+        clear_question_cache(questions_path, selected_title)
         st.rerun()
     if st.session_state.is_authenticated:
         with st.expander("返信する", expanded=False):
@@ -335,23 +422,32 @@ def show_chat_thread():
                 reply_image = st.file_uploader("画像をアップロード", type=["png", "jpg", "jpeg"])
                 submitted = st.form_submit_button("送信")
                 if submitted:
-                    processed_reply = process_image(reply_image) if reply_image is not None else None
+                    reply_image_ref = store_image(db, collection_prefix, reply_image) if reply_image is not None else None
                     if not reply_text.strip() and not reply_image:
                         st.error("少なくともメッセージか画像を投稿してください。")
                     else:
                         time_str = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d %H:%M:%S")
-                        db.collection("questions").add({
+                        extra = [(threads_path, thread_doc_id(selected_title), teacher_post_stats(selected_title, time_str))]
+                        if reply_image_ref:
+                            extra.append(image_link(collection_prefix, reply_image_ref))
+                        accepted = write_queue.submit(st.session_state.reply_idempotency_key, questions_path, {
                             "title": selected_title,
                             "question": "[先生] " + reply_text.strip(),
-                            "image": processed_reply,
+                            "image": None,
+                            "image_ref": reply_image_ref,
                             "timestamp": time_str,
                             "deleted": 0,
-                        })
-                        st.cache_resource.clear()
-                        st.success("返信を送信しました！")
-                        st.rerun()
+                        }, extra=extra, owner=st.session_state.writer_id)
+                        # 受け付けられなかった場合も、次の送信が同じキーで弾かれないようキーは必ず作り直す
+                        st.session_state.reply_idempotency_key = uuid.uuid4().hex
+                        if accepted:
+                            st.success("返信を送信しました！")
+                            st.rerun()
+                        else:
+                            st.error("返信を受け付けられませんでした。もう一度送信してください。")
    
     if st.button("戻る", key="chat_back"):
+        mark_thread_read(selected_title)
         st.session_state.selected_title = None
         st.rerun()
 